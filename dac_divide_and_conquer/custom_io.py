@@ -1,9 +1,9 @@
-from ast import Dict
+from collections.abc import MutableMapping
 import itertools
 import os
 from pathlib import Path
 import pickle
-from typing import List
+from typing import Dict, List
 
 
 def load_pickle(path: Path):
@@ -16,6 +16,51 @@ def save_as_pickle(object, path: Path):
         pickle.dump(object, f)
 
 
+def fasttext_line(text: str, labels: List[str]):
+    return f"{' '.join(f'__label__<{label}>' for label in set(labels))} <{text}>"
+
+
+class LazyPickleDict(MutableMapping):
+    """
+    Dict whose values are pickles that are loaded from their path the first time their key is accessed.
+    """
+
+    def __init__(self, paths: Dict[str, Path], missing_as_none: bool = False):
+        """
+        :param paths: path of the pickle of each key
+        :param missing_as_none: return None for keys whose pickle does not exist instead of raising FileNotFoundError
+        """
+        self.paths = paths
+        self.missing_as_none = missing_as_none
+        self.loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            path = self.paths[key]
+            try:
+                self.loaded[key] = load_pickle(path)
+            except FileNotFoundError:
+                if not self.missing_as_none:
+                    raise
+                self.loaded[key] = None
+        return self.loaded[key]
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+
+    def __delitem__(self, key):
+        if key not in self.loaded and key not in self.paths:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.paths.pop(key, None)
+
+    def __iter__(self):
+        return iter({**dict.fromkeys(self.paths), **dict.fromkeys(self.loaded)})
+
+    def __len__(self):
+        return len(self.paths.keys() | self.loaded.keys())
+
+
 def write_fasttext_file(sentences: List[str], labels: List[List[str]], filepath: Path):
     sentences_without_lines = [text.replace("\n", " ") for text in sentences]
     lines = []
@@ -24,7 +69,7 @@ def write_fasttext_file(sentences: List[str], labels: List[List[str]], filepath:
             continue
         if not text:
             continue
-        lines.append(f"{' '.join(f'__label__<{label}>' for label in set(list_of_labels))} <{text}>")
+        lines.append(fasttext_line(text, list_of_labels))
     with open(filepath, "w") as file:
         file.write("\n".join(lines))
 
@@ -1,7 +1,8 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import statistics
 from typing import List
+import numpy as np
 from dac_divide_and_conquer.dataset.base import DACCorpus
 from dac_divide_and_conquer.flair_utils import get_label_value, read_corpus
 from dac_divide_and_conquer.metrics import Metrics, calculate_mean_average_precision, calculate_summary
@@ -10,6 +11,38 @@ from dac_divide_and_conquer.model.dac import DACModel
 from dac_divide_and_conquer import logger
 
 
+def load_dac_models(
+    corpus: DACCorpus,
+    transformers: List[str],
+    seeds: List[int],
+    load_ranker_from_gcp: bool = False,
+    load_matcher_from_gcp: bool = False,
+):
+    """
+    Yields the models in order, loading the next one in a background thread while the current one is being used so
+    downloads from GCP and disk reads overlap with prediction. The ranker pickles are read eagerly so they are not
+    unpickled on the main thread during predict.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = (
+            executor.submit(
+                DACModel.load,
+                corpus,
+                matcher_transformer=transformer,
+                seed=seed,
+                load_ranker_from_gcp=load_ranker_from_gcp,
+                load_matcher_from_gcp=load_matcher_from_gcp,
+                lazy_ranker=False,
+            )
+            for transformer, seed in zip(transformers, seeds)
+        )
+        next_model = next(futures, None)
+        while next_model is not None:
+            current_model = next_model
+            next_model = next(futures, None)
+            yield current_model.result()
+
+
 def eval_mean(
     corpus: DACCorpus,
     transformers: List[str],
@@ -18,32 +51,24 @@ def eval_mean(
     load_ranker_from_gcp: bool = False,
     metrics: List[Metrics] = [Metrics.map, Metrics.summary],
     first_n_digits: int = 0,
+    mini_batch_size: int = 64,
 ):
     assert len(transformers) == len(seeds)
     maps = []
     f1_scores = []
     precisions = []
     recalls = []
-    corpus = read_corpus(corpus.indexer_path / "corpus", "corpus")
-    sentences = [s for s in corpus.test]
-    for transformer, seed in zip(transformers, seeds):
-        dac = DACModel.load(
-            corpus,
-            matcher_transformer=transformer,
-            seed=seed,
-            load_ranker_from_gcp=load_ranker_from_gcp,
-            load_matcher_from_gcp=load_matcher_from_gcp,
-        )
+    sentences = list(read_corpus(corpus.indexer_path / "corpus", "corpus").test)
+    for dac in load_dac_models(corpus, transformers, seeds, load_ranker_from_gcp, load_matcher_from_gcp):
         logger.info(f"Predicting {dac.name}")
+        dac.predict(sentences, return_probabilities=True, mini_batch_size=mini_batch_size)
         for metric in metrics:
-            return_probabilities = metric == Metrics.map
-            label_name = "label_predicted_proba" if return_probabilities else "label_predicted"
-            dac.predict(sentences, return_probabilities=return_probabilities)
             if metric == Metrics.map:
-                map_s = calculate_mean_average_precision(sentences, dac.mappings.keys(), label_name)
+                map_s = calculate_mean_average_precision(sentences, dac.mappings.keys(), "label_predicted_proba")
                 logger.info(f"MAP {dac.name}: {map_s}")
                 maps.append(map_s)
             elif metric == Metrics.summary:
+                dac.predict(sentences, return_probabilities=False, reuse_proba=True)
                 f1_score, precision, recall = calculate_summary(
                     sentences, dac.mappings.keys(), first_n_digits=first_n_digits, output_full=False
                 )
@@ -66,37 +91,35 @@ def eval_ensemble(
     load_from_gcp: bool = False,
     metrics: List[Metrics] = [Metrics.map, Metrics.summary],
     first_n_digits: int = 0,
+    mini_batch_size: int = 64,
 ):
     assert len(transformers) == len(seeds)
     results_evaluation = {}
+    sentences = list(read_corpus(corpus.indexer_path / "corpus", "corpus").test)
+    for dac in load_dac_models(corpus, transformers, seeds, load_from_gcp, load_from_gcp):
+        logger.info(f"Predicting {dac.name}")
+        dac.predict(sentences, label_name=dac.name, return_probabilities=True, mini_batch_size=mini_batch_size)
+        if Metrics.summary in metrics:
+            dac.predict(sentences, label_name=f"{dac.name}-predicted", return_probabilities=False, reuse_proba=True)
+
     for metric in metrics:
         return_probabilities = metric == Metrics.map
-        corpus = read_corpus(corpus.indexer_path / "corpus", "corpus")
-        sentences = [s for s in corpus.test]
-        for transformer, seed in zip(transformers, seeds):
-            dac = DACModel.load(
-                corpus,
-                matcher_transformer=transformer,
-                seed=seed,
-                load_ranker_from_gcp=load_from_gcp,
-                load_matcher_from_gcp=load_from_gcp,
-            )
-            logger.info(f"Predicting {dac.name}")
-            dac.predict(sentences, label_name=dac.name, return_probabilities=return_probabilities)
-
         label_name = "label_predicted_proba" if return_probabilities else "label_predicted"
-        for sentence in sentences:
-            labels = defaultdict(list)
-            for transformer, seed in zip(transformers, seeds):
-                name = f"{transformer}-{seed}"
+        aggregate = np.maximum if ensemble_type == "max" else np.add
+        labels_list = list(dac.mappings.keys())
+        label_indexes = {label: j for j, label in enumerate(labels_list)}
+        ensemble_scores = np.zeros((len(sentences), len(labels_list)))
+        for transformer, seed in zip(transformers, seeds):
+            name = f"{transformer}-{seed}" if return_probabilities else f"{transformer}-{seed}-predicted"
+            model_scores = np.zeros_like(ensemble_scores)
+            for i, sentence in enumerate(sentences):
                 for label in sentence.get_labels(name):
-                    labels[get_label_value(label)].append(label.score)
-            for label, scores in labels.items():
-                if metric == Metrics.map:
-                    score = max(scores) if ensemble_type == "max" else sum(scores)
-                    sentence.add_label(label_name, label, score)
-                elif metric == Metrics.summary:
-                    sentence.add_label(label_name, label, 1.0)
+                    j = label_indexes.get(get_label_value(label))
+                    if j is not None:
+                        model_scores[i, j] = label.score
+            aggregate(ensemble_scores, model_scores, out=ensemble_scores)
+        for i, j in zip(*np.nonzero(ensemble_scores)):
+            sentences[i].add_label(label_name, labels_list[j], ensemble_scores[i, j] if return_probabilities else 1.0)
         if metric == Metrics.map:
             score = calculate_mean_average_precision(sentences, dac.mappings.keys(), label_name)
             results_evaluation[str(metric)] = score
@@ -119,18 +142,12 @@ def component_analysis(
     load_ranker_from_gcp: bool = False,
     metrics: List[Metrics] = [Metrics.map, Metrics.summary],
     first_n_digits: int = 0,
+    mini_batch_size: int = 64,
 ):
     all_scores = {}
-    for transformer, seed in zip(transformers, seeds):
-        dac = DACModel.load(
-            corpus,
-            matcher_transformer=transformer,
-            seed=seed,
-            load_ranker_from_gcp=load_ranker_from_gcp,
-            load_matcher_from_gcp=load_matcher_from_gcp,
-        )
-        scores = dac.eval(eval_metrics=metrics, first_n_digits_summary=first_n_digits)
-        all_scores[f"{transformer}-{seed}"] = scores
+    for dac in load_dac_models(corpus, transformers, seeds, load_ranker_from_gcp, load_matcher_from_gcp):
+        scores = dac.eval(eval_metrics=metrics, first_n_digits_summary=first_n_digits, mini_batch_size=mini_batch_size)
+        all_scores[dac.name] = scores
     logger.info(all_scores)
     with open(dac.models_path / dac.indexer / "component_analysis.json", "w") as f:
         json.dump(all_scores, f)
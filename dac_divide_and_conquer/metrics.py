@@ -1,11 +1,11 @@
 from enum import Enum
 import itertools
-import statistics
 from typing import List
 import numpy as np
-from sklearn.metrics import average_precision_score, classification_report, f1_score, precision_score, recall_score
+from sklearn.metrics import classification_report, f1_score, precision_score, recall_score
 
 from dac_divide_and_conquer.flair_utils import get_label_value
+from dac_divide_and_conquer.utils import chunks
 from dac_divide_and_conquer import logger
 
 
@@ -14,28 +14,75 @@ class Metrics(Enum):
     summary = "summary"  # f1, precision, recall, accuracy
 
 
-def calculate_mean_average_precision(sentences, labels_list: List[str], label_name_predicted="label_predicted_proba"):
+def calculate_mean_average_precision(
+    sentences, labels_list: List[str], label_name_predicted="label_predicted_proba", chunk_size: int = 128
+):
     if not sentences:
         return
     logger.info(f"Calculating map for {label_name_predicted}")
     label_indexes = {label: i for i, label in enumerate(set(labels_list))}
-    avg_precs = []
-    for sentence in sentences:
-        gold = np.zeros(len(label_indexes))
-        pred = np.zeros(len(label_indexes))
-        for label in sentence.get_labels("gold"):
-            if label.value not in ["<unk>", "unk"]:
-                gold[label_indexes[get_label_value(label)]] = 1
-        for label in sentence.get_labels(label_name_predicted):
-            if label.value not in ["<unk>", "unk"]:
-                pred[label_indexes[get_label_value(label)]] = label.score
-        if gold.any():
-            avg_precs.append(average_precision_score(gold, pred))
-    map_s = statistics.mean(avg_precs)
+    aps = []
+    for sentences_chunk in chunks(sentences, chunk_size):
+        gold = np.zeros((len(sentences_chunk), len(label_indexes)), dtype=np.int8)
+        pred = np.zeros((len(sentences_chunk), len(label_indexes)))
+        for i, sentence in enumerate(sentences_chunk):
+            for label in sentence.get_labels("gold"):
+                if label.value not in ["<unk>", "unk"]:
+                    gold[i, label_indexes[get_label_value(label)]] = 1
+            for label in sentence.get_labels(label_name_predicted):
+                if label.value not in ["<unk>", "unk"]:
+                    pred[i, label_indexes[get_label_value(label)]] = label.score
+        aps.append(_average_precision_of_rows_with_gold(gold, pred))
+    map_s = _mean_of_average_precisions(aps)
     logger.info(map_s)
     return map_s
 
 
+def calculate_mean_average_precision_matrix(y_true: np.ndarray, y_score: np.ndarray, chunk_size: int = 128) -> float:
+    """
+    MAP over the rows of y_true that have at least one positive label, 0 if there are none. Rows are processed in
+    chunks to bound the memory used by the intermediate matrices.
+    """
+    y_true = np.asarray(y_true)
+    y_score = np.asarray(y_score)
+    aps = [
+        _average_precision_of_rows_with_gold(true_chunk, score_chunk)
+        for true_chunk, score_chunk in zip(chunks(y_true, chunk_size), chunks(y_score, chunk_size))
+    ]
+    return _mean_of_average_precisions(aps)
+
+
+def _average_precision_of_rows_with_gold(y_true: np.ndarray, y_score: np.ndarray) -> np.ndarray:
+    with_gold = y_true.any(axis=1)
+    return average_precision_per_sample(y_true[with_gold], y_score[with_gold])
+
+
+def _mean_of_average_precisions(aps: List[np.ndarray]) -> float:
+    aps = np.concatenate(aps) if aps else np.array([])
+    return float(aps.mean()) if aps.size else 0.0
+
+
+def average_precision_per_sample(y_true: np.ndarray, y_score: np.ndarray) -> np.ndarray:
+    """
+    Vectorized equivalent of calling average_precision_score on each row. Tied scores are grouped like sklearn
+    does, rows without positives get 0.
+    """
+    y_true = np.asarray(y_true)
+    y_score = np.asarray(y_score)
+    n_labels = y_score.shape[1]
+    order = np.argsort(-y_score, axis=1, kind="stable")
+    y_sorted = np.take_along_axis(y_true, order, axis=1)
+    scores_sorted = np.take_along_axis(y_score, order, axis=1)
+    true_positives = y_sorted.cumsum(axis=1)
+    positions = np.arange(n_labels)
+    is_group_end = np.ones_like(scores_sorted, dtype=bool)
+    is_group_end[:, :-1] = scores_sorted[:, :-1] != scores_sorted[:, 1:]
+    group_end = np.where(is_group_end, positions, n_labels)
+    group_end = np.minimum.accumulate(group_end[:, ::-1], axis=1)[:, ::-1]
+    precision = np.take_along_axis(true_positives, group_end, axis=1) / (group_end + 1)
+    return (precision * y_sorted).sum(axis=1) / y_sorted.sum(axis=1).clip(min=1)
+
+
 def calculate_summary(
     sentences,
     labels_list: List[str],
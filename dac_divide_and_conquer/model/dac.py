@@ -40,8 +40,9 @@ class DACModel:
         seed: int = 0,
         load_ranker_from_gcp: bool = False,
         load_matcher_from_gcp: bool = False,
+        lazy_ranker: bool = True,
     ):
-        ranker = Ranker.load(corpus, load_from_gcp=load_ranker_from_gcp, seed=seed)
+        ranker = Ranker.load(corpus, load_from_gcp=load_ranker_from_gcp, seed=seed, lazy=lazy_ranker)
         matcher = Matcher.load(corpus, transformer=matcher_transformer, seed=seed, load_from_gcp=load_matcher_from_gcp)
         return cls(corpus, ranker=ranker, matcher=matcher, matcher_transformer=matcher_transformer, seed=seed)
 
@@ -70,16 +71,36 @@ class DACModel:
         self.ranker.save()
 
     def predict(
-        self, sentences: List[Sentence], return_probabilities: bool = True, label_name: str = None, filenames=None
+        self,
+        sentences: List[Sentence],
+        return_probabilities: bool = True,
+        label_name: str = None,
+        filenames=None,
+        reuse_proba: bool = False,
+        mini_batch_size: int = 64,
     ):
+        """
+        :param reuse_proba: Only used when return_probabilities is False. Derives the matcher and ranker predictions
+            from the probabilities left by a previous call with return_probabilities=True instead of running them again
+        :param mini_batch_size: Batch size of the matcher transformer. Flair sorts the sentences by length before
+            batching, so larger batches waste little padding and improve GPU throughput
+        """
         if not label_name:
             label_name = "label_predicted_proba" if return_probabilities else "label_predicted"
 
         if not filenames:
             filenames = self.corpus.filenames["test"]
 
-        self.matcher.predict(sentences, return_probabilities=return_probabilities, filenames=filenames)
-        self.ranker.predict(sentences, return_probabilities=return_probabilities, filenames=filenames)
+        if reuse_proba and not return_probabilities:
+            self.predictions_from_probabilities(sentences, filenames)
+        else:
+            self.matcher.predict(
+                sentences,
+                return_probabilities=return_probabilities,
+                filenames=filenames,
+                mini_batch_size=mini_batch_size,
+            )
+            self.ranker.predict(sentences, return_probabilities=return_probabilities, filenames=filenames)
         if return_probabilities:
             self.mix_with_probabilities(sentences, label_name)
         else:
@@ -93,6 +114,10 @@ class DACModel:
             filenames,
         )
 
+    def predictions_from_probabilities(self, sentences: List[Sentence], filenames: List[str]):
+        self.matcher.predictions_from_probabilities(sentences, filenames=filenames)
+        self.ranker.predictions_from_probabilities(sentences, filenames=filenames)
+
     def mix_with_probabilities(self, sentences: List[Sentence], label_name: str):
         logger.info("Joining probabilities")
         for sentence in sentences:
@@ -139,29 +164,32 @@ class DACModel:
         first_n_digits_summary: int = 0,
         eval_ranker: bool = True,
         eval_matcher: bool = True,
+        mini_batch_size: int = 64,
     ):
         scores_matcher, scores_ranker = 0.0, 0.0
         if eval_matcher:
             corpus_matcher = read_corpus(self.indexers_path / self.indexer / "matcher", "matcher")
-            sentences_matcher = [s for s in corpus_matcher.test]
-            scores_matcher = self.matcher.eval(sentences_matcher, eval_metrics=eval_metrics)
+            sentences_matcher = list(corpus_matcher.test)
+            scores_matcher = self.matcher.eval(
+                sentences_matcher, eval_metrics=eval_metrics, mini_batch_size=mini_batch_size
+            )
         if eval_ranker:
             scores_ranker = self.ranker.eval_weighted(
                 eval_weighted_metrics=eval_metrics, first_n_digits=first_n_digits_summary
             )
 
         corpus = read_corpus(self.indexers_path / self.indexer / "corpus", "corpus")
-        sentences = [s for s in corpus.test]
+        sentences = list(corpus.test)
         scores_dac = {}
+        self.predict(sentences, mini_batch_size=mini_batch_size)
         for metric in eval_metrics:
             if metric == Metrics.map:
-                self.predict(sentences)
                 score = calculate_mean_average_precision(
                     sentences, self.mappings.keys(), label_name_predicted="label_predicted_proba"
                 )
                 scores_dac[metric.value] = score
             elif metric == Metrics.summary:
-                self.predict(sentences, return_probabilities=False)
+                self.predict(sentences, return_probabilities=False, reuse_proba=True)
                 f1_score, precision, recall = calculate_summary(
                     sentences,
                     self.mappings.keys(),
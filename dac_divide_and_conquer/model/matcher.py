@@ -1,11 +1,11 @@
 import itertools
-from collections import defaultdict
+from contextlib import ExitStack
 from pathlib import Path
 from typing import Dict, List, Union
 
 import torch
 from dac_divide_and_conquer import logger
-from dac_divide_and_conquer.custom_io import create_dir_if_dont_exist, load_mappings, write_fasttext_file
+from dac_divide_and_conquer.custom_io import create_dir_if_dont_exist, fasttext_line, load_mappings
 from dac_divide_and_conquer.dataset import Augmentation
 from dac_divide_and_conquer.dataset.base import DACCorpus
 from dac_divide_and_conquer.flair_utils import (
@@ -143,14 +143,24 @@ class Matcher:
         )
         if upload_to_gcp:
             self.upload_to_gcp()
-        self.eval([s for s in corpus.dev])
-        self.eval([s for s in corpus.test])
+        self.eval(list(corpus.dev), filenames=self.corpus.filenames.get("dev"))
+        self.eval(list(corpus.test))
 
-    def predict(self, sentences: List[Sentence], return_probabilities=True, filenames: List[str] = []):
+    def predict(
+        self,
+        sentences: List[Sentence],
+        return_probabilities=True,
+        filenames: List[str] = [],
+        mini_batch_size: int = 64,
+    ):
         logger.info("Predicting matcher")
         label_name = "matcher_proba" if return_probabilities else "matcher"
         self.classifier.predict(
-            sentences, label_name=label_name, return_probabilities_for_all_classes=return_probabilities
+            sentences,
+            label_name=label_name,
+            return_probabilities_for_all_classes=return_probabilities,
+            mini_batch_size=mini_batch_size,
+            embedding_storage_mode="none",
         )
 
         if not filenames:
@@ -165,21 +175,53 @@ class Matcher:
             filenames,
         )
 
-    def eval(self, sentences, eval_metrics: List[Metrics] = [Metrics.map, Metrics.summary]):
+    def predictions_from_probabilities(self, sentences: List[Sentence], filenames: List[str] = []):
+        """
+        Adds the labels predict would add with return_probabilities=False using the matcher_proba labels of a
+        previous predict, without running the classifier again.
+        """
+        threshold = self.classifier.multi_label_threshold
+        for sentence in sentences:
+            sentence.remove_labels("matcher")
+            for label in sentence.get_labels("matcher_proba"):
+                if label.score > threshold.get(label.value, threshold["default"]):
+                    sentence.add_label("matcher", label.value, label.score)
+
+        if not filenames:
+            filenames = self.corpus.filenames["test"]
+
+        save_predictions_to_file(
+            self.models_path / self.indexer / "predictions_matcher",
+            f"{self.name}.json",
+            sentences,
+            "matcher",
+            False,
+            filenames,
+        )
+
+    def eval(
+        self,
+        sentences,
+        eval_metrics: List[Metrics] = [Metrics.map, Metrics.summary],
+        filenames: List[str] = [],
+        mini_batch_size: int = 64,
+    ):
         if not sentences:
             return
         logger.info("Evaluation of Matcher")
         scores = {}
+        self.predict(sentences, return_probabilities=True, filenames=filenames, mini_batch_size=mini_batch_size)
         for metric in eval_metrics:
             labels_list = (
                 itertools.chain.from_iterable(self.mappings.values()) if self.multi_cluster else self.mappings.values()
             )
             if metric == Metrics.map:
-                self.predict(sentences, return_probabilities=True)
                 score = calculate_mean_average_precision(sentences, labels_list, label_name_predicted="matcher_proba")
                 scores[metric.value] = score
             elif metric == Metrics.summary:
-                self.predict(sentences, return_probabilities=False)
+                self.predict(
+                    sentences, return_probabilities=False, filenames=filenames, mini_batch_size=mini_batch_size
+                )
                 f1_score, precision, recall = calculate_summary(sentences, labels_list, label_name_predicted="matcher")
                 scores[metric.value] = f1_score
                 scores["precision"] = precision
@@ -188,22 +230,28 @@ class Matcher:
 
     def create_corpus_of_incorrectly_predicted(self):
         corpus = read_corpus(self.indexers_path / self.indexer / "corpus", "corpus")
-        sentences = [sentence for sentence in corpus.dev]
+        sentences = list(corpus.dev)
         self.predict(sentences, return_probabilities=False)
-        sentences_incorrect = defaultdict(list)
-        for sentence in sentences:
-            for label in sentence.get_labels("predicted"):
-                if get_label_value(label) == "unk":
+        incorrect_matcher_path = self.models_path / self.indexer / "incorrect-matcher"
+        with ExitStack() as stack:
+            cluster_files = {}
+            for sentence in sentences:
+                text = sentence.to_original_text().replace("\n", " ")
+                if not text:
                     continue
-                cluster_predicted = get_label_value(label)
                 clusters_gold = [self.mappings[get_label_value(ll)] for ll in sentence.get_labels("gold")]
                 if self.multi_cluster:
-                    clusters_gold = itertools.chain.from_iterable(clusters_gold)
-                if cluster_predicted not in clusters_gold:
-                    sentences_incorrect[cluster_predicted].append(sentence.to_original_text())
-        for cluster in sentences_incorrect.keys():
-            write_fasttext_file(
-                sentences_incorrect[cluster],
-                [["incorrect-matcher"]] * len(sentences_incorrect[cluster]),
-                self.models_path / self.indexer / "incorrect-matcher" / f"incorrect_{cluster}_train.txt",
-            )
+                    clusters_gold = set(itertools.chain.from_iterable(clusters_gold))
+                for label in sentence.get_labels("matcher"):
+                    if get_label_value(label) == "unk":
+                        continue
+                    cluster_predicted = get_label_value(label)
+                    if cluster_predicted in clusters_gold:
+                        continue
+                    if cluster_predicted not in cluster_files:
+                        cluster_files[cluster_predicted] = stack.enter_context(
+                            open(incorrect_matcher_path / f"incorrect_{cluster_predicted}_train.txt", "w")
+                        )
+                    else:
+                        cluster_files[cluster_predicted].write("\n")
+                    cluster_files[cluster_predicted].write(fasttext_line(text, ["incorrect-matcher"]))
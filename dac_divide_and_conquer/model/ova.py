@@ -100,6 +100,6 @@ class OVA:
     def eval(self):
         logger.info("Eval OVA")
         corpus = read_corpus(self.indexers_path / self.indexer / "corpus", "corpus")
-        sentences = [s for s in corpus.test]
+        sentences = list(corpus.test)
         self.predict(sentences)
         calculate_mean_average_precision(sentences, self.mappings.keys(), label_name_predicted="ova")
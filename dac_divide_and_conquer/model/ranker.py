@@ -1,26 +1,30 @@
+import copy
 import itertools
 import multiprocessing
-import statistics
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Set, Union
 from more_itertools import first
+from scipy import sparse
 
 import numpy as np
+import torch
 from dac_divide_and_conquer import logger
-from dac_divide_and_conquer.custom_io import create_dir_if_dont_exist, load_mappings, load_pickle, save_as_pickle
+from dac_divide_and_conquer.custom_io import LazyPickleDict, create_dir_if_dont_exist, load_mappings, save_as_pickle
 from dac_divide_and_conquer.dataset.base import DACCorpus
 from dac_divide_and_conquer.flair_utils import read_augmentation_corpora, read_corpus, save_predictions_to_file
 from dac_divide_and_conquer.gcp import download_blob_file, upload_blob_file
-from dac_divide_and_conquer.metrics import Metrics
+from dac_divide_and_conquer.metrics import Metrics, calculate_mean_average_precision_matrix
 from dac_divide_and_conquer.dataset import Augmentation
-from dac_divide_and_conquer.utils import chunks, label_in_cluster
+from dac_divide_and_conquer.utils import chunks, labels_per_cluster
 from flair.data import MultiCorpus, Sentence
 from flair.embeddings import TransformerDocumentEmbeddings
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import average_precision_score, f1_score, precision_score, recall_score
+from joblib import Parallel, delayed
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.metrics import f1_score, precision_score, recall_score
 from sklearn.multiclass import OneVsRestClassifier
-from sklearn.preprocessing import MultiLabelBinarizer
-from xgboost import XGBClassifier
+from sklearn.preprocessing import MultiLabelBinarizer, normalize
+from xgboost import DMatrix, XGBClassifier
 
 
 class Ranker:
@@ -46,9 +50,14 @@ class Ranker:
         self.cluster_label_binarizer: Dict[str, MultiLabelBinarizer] = cluster_label_binarizer
         self.cluster_tfidf = cluster_tfidf
         self.mappings, self.clusters, self.multi_cluster = load_mappings(self.indexers_path, self.indexer)
+        self._cluster_labels: Dict[str, Set[str]] = labels_per_cluster(self.mappings, self.multi_cluster)
         self.seed = seed
         self.dir_name = f"ranker-{seed}"
         self.transformer_for_embedding = None
+        self._embedding_cache: Dict[int, np.ndarray] = {}
+        self._global_vectorizer: CountVectorizer = None
+        self._cluster_columns: Dict[str, np.ndarray] = {}
+        self._class_to_column: Dict[str, Dict[str, int]] = {}
         Ranker.create_directories(self.models_path, self.indexer, seed)
 
     @classmethod
@@ -57,31 +66,45 @@ class Ranker:
         create_dir_if_dont_exist(models_path / indexer / f"ranker-{seed}")
 
     @classmethod
-    def load(cls, corpus: DACCorpus, load_from_gcp: bool = False, seed: int = 0):
+    def load(
+        cls,
+        corpus: DACCorpus,
+        load_from_gcp: bool = False,
+        seed: int = 0,
+        n_download_workers: int = 8,
+        lazy: bool = True,
+    ):
+        """
+        :param lazy: if True the pickles of each cluster are read the first time they are used, otherwise all of them
+            are read here
+        """
         models_path = corpus.models_path
         indexer = corpus.corpus
         indexers_path = corpus.indexers_path
         cls.create_directories(models_path, indexer, seed)
         _, clusters, _ = load_mappings(indexers_path, indexer)
-        cluster_classifier = {}
-        cluster_label_binarizer = {}
-        cluster_tfidf = {}
+        label_binarizer_paths, classifier_paths, tfidf_paths = {}, {}, {}
         dir_name = f"ranker-{seed}"
+        downloads = []
         for cluster in clusters:
-            label_binarizer_path = models_path / indexer / dir_name / f"label_binarizer_{cluster}.pickle"
-            classifier_path = models_path / indexer / dir_name / f"classifier_{cluster}.pickle"
-            tfidf_path = models_path / indexer / dir_name / f"tfidf_{cluster}.pickle"
-            if load_from_gcp:
-                download_blob_file(f"{indexer}/{dir_name}/label_binarizer_{cluster}.pickle", label_binarizer_path)
-                download_blob_file(f"{indexer}/{dir_name}/classifier_{cluster}.pickle", classifier_path)
-                download_blob_file(f"{indexer}/{dir_name}/tfidf_{cluster}.pickle", tfidf_path)
-            cluster_label_binarizer[cluster] = load_pickle(label_binarizer_path)
-            try:
-                cluster_classifier[cluster] = load_pickle(classifier_path)
-                cluster_tfidf[cluster] = load_pickle(tfidf_path)
-            except FileNotFoundError:
-                cluster_classifier[cluster] = None
-                cluster_tfidf[cluster] = None
+            label_binarizer_paths[cluster] = models_path / indexer / dir_name / f"label_binarizer_{cluster}.pickle"
+            classifier_paths[cluster] = models_path / indexer / dir_name / f"classifier_{cluster}.pickle"
+            tfidf_paths[cluster] = models_path / indexer / dir_name / f"tfidf_{cluster}.pickle"
+            downloads += [
+                (f"{indexer}/{dir_name}/label_binarizer_{cluster}.pickle", label_binarizer_paths[cluster]),
+                (f"{indexer}/{dir_name}/classifier_{cluster}.pickle", classifier_paths[cluster]),
+                (f"{indexer}/{dir_name}/tfidf_{cluster}.pickle", tfidf_paths[cluster]),
+            ]
+        if load_from_gcp:
+            with ThreadPoolExecutor(max_workers=n_download_workers) as executor:
+                list(executor.map(lambda download: download_blob_file(*download), downloads))
+        cluster_label_binarizer = LazyPickleDict(label_binarizer_paths)
+        cluster_classifier = LazyPickleDict(classifier_paths, missing_as_none=True)
+        cluster_tfidf = LazyPickleDict(tfidf_paths, missing_as_none=True)
+        if not lazy:
+            cluster_label_binarizer = dict(cluster_label_binarizer)
+            cluster_classifier = dict(cluster_classifier)
+            cluster_tfidf = dict(cluster_tfidf)
         return cls(
             corpus,
             cluster_classifier=cluster_classifier,
@@ -116,43 +139,138 @@ class Ranker:
 
     def _set_multi_label_binarizer(self, cluster: str):
         mlb = MultiLabelBinarizer()
-        labels_cluster = {
-            f"<{label}>"
-            for label in self.mappings.keys()
-            if label_in_cluster(cluster, label, self.mappings, self.multi_cluster)
-        }
+        labels_cluster = {f"<{label}>" for label in self._cluster_labels[cluster]}
         mlb.fit([list(labels_cluster) + ["<incorrect-matcher>"]])
         self.cluster_label_binarizer[cluster] = mlb
+        self._class_to_column[cluster] = {label: i for i, label in enumerate(mlb.classes_)}
 
     def _set_tfidf(self, cluster: str, sentences: List[str]):
         logger.info("Fitting tf-idf")
         tfidf = TfidfVectorizer()
-        tfidf.fit(s.to_original_text() for s in sentences)
+        tfidf_embeddings = tfidf.fit_transform(s.to_original_text() for s in sentences)
         self.cluster_tfidf[cluster] = tfidf
+        self._global_vectorizer = None
         logger.info("Finished fitting tf-idf")
+        return tfidf_embeddings
+
+    def _set_global_vectorizer(self):
+        """
+        Builds a CountVectorizer over the union of the vocabularies of every cluster tf-idf and the columns each
+        cluster uses from it, so predict tokenizes the sentences once instead of once per cluster.
+        """
+        tfidfs = {cluster: tfidf for cluster, tfidf in self.cluster_tfidf.items() if tfidf}
+        global_vocabulary = sorted(set().union(*[tfidf.vocabulary_ for tfidf in tfidfs.values()]))
+        term_to_column = {term: i for i, term in enumerate(global_vocabulary)}
+        self._cluster_columns = {
+            cluster: np.array(
+                [term_to_column[term] for term in sorted(tfidf.vocabulary_, key=tfidf.vocabulary_.get)],
+                dtype=np.int64,
+            )
+            for cluster, tfidf in tfidfs.items()
+        }
+        self._global_vectorizer = CountVectorizer(vocabulary=global_vocabulary) if global_vocabulary else None
+
+    @staticmethod
+    def _weight_counts(tfidf: TfidfVectorizer, counts):
+        """
+        Applies the weighting of a fitted tf-idf to a counts matrix of its vocabulary, the same as its transform.
+        """
+        embeddings = counts.tocsr().astype(np.float64)
+        if tfidf.sublinear_tf:
+            np.log(embeddings.data, embeddings.data)
+            embeddings.data += 1
+        if tfidf.use_idf:
+            embeddings = embeddings @ sparse.diags(tfidf.idf_)
+        if tfidf.norm:
+            embeddings = normalize(embeddings, norm=tfidf.norm, copy=False)
+        return embeddings.tocsr()
+
+    def _get_global_counts(self, sentences: List[Sentence]):
+        if not self._global_vectorizer:
+            self._set_global_vectorizer()
+        if not self._global_vectorizer:
+            return None
+        return self._global_vectorizer.transform(s.to_original_text() for s in sentences).tocsc()
 
     def _get_labels_matrix(self, cluster: str, sentences: List[Sentence]):
-        mlb = self.cluster_label_binarizer[cluster]
-        labels_matrix = mlb.transform([[label.value for label in s.get_labels("gold")] for s in sentences])
+        if cluster not in self._class_to_column:
+            classes = self.cluster_label_binarizer[cluster].classes_
+            self._class_to_column[cluster] = {label: i for i, label in enumerate(classes)}
+        class_to_column = self._class_to_column[cluster]
+        rows, columns = [], []
+        for i, sentence in enumerate(sentences):
+            for label in sentence.get_labels("gold"):
+                column = class_to_column.get(label.value)
+                if column is not None:
+                    rows.append(i)
+                    columns.append(column)
+        labels_matrix = np.zeros((len(sentences), len(class_to_column)), dtype=np.int8)
+        labels_matrix[rows, columns] = 1
         return labels_matrix
 
-    def _get_embeddings(self, cluster: str, sentences: List[Sentence], transformer_for_embedding: str = None):
-        self.transformer_for_embedding = (
-            TransformerDocumentEmbeddings(transformer_for_embedding, layers="-1,-2,-3,-4", fine_tune=False)
-            if not self.transformer_for_embedding and transformer_for_embedding
-            else None
-        )
-        embeddings = self.cluster_tfidf[cluster].transform(s.to_original_text() for s in sentences)
+    def _embed_with_transformer(self, sentences: List[Sentence]) -> Dict[int, np.ndarray]:
+        self.transformer_for_embedding.model.eval()
+        transformer_embeddings = {}
+        for chunk in chunks(sentences):
+            self.transformer_for_embedding.embed(chunk)
+            chunk_embeddings = torch.stack([sentence.embedding.detach() for sentence in chunk]).cpu().numpy()
+            for sentence, embedding in zip(chunk, chunk_embeddings):
+                transformer_embeddings[id(sentence)] = embedding
+                sentence.clear_embeddings()
+        return transformer_embeddings
+
+    def _precompute_transformer_embeddings(self, sentences: List[Sentence]):
+        if not self.transformer_for_embedding:
+            return
+        missing = [s for s in sentences if id(s) not in self._embedding_cache]
+        self._embedding_cache.update(self._embed_with_transformer(missing))
+
+    def _get_embeddings(
+        self,
+        cluster: str,
+        sentences: List[Sentence],
+        transformer_for_embedding: str = None,
+        global_counts=None,
+        tfidf_embeddings=None,
+    ):
+        if not self.transformer_for_embedding and transformer_for_embedding:
+            self.transformer_for_embedding = TransformerDocumentEmbeddings(
+                transformer_for_embedding, layers="-1,-2,-3,-4", fine_tune=False
+            )
+        tfidf = self.cluster_tfidf[cluster]
+        if tfidf_embeddings is not None:
+            embeddings = tfidf_embeddings
+        elif global_counts is not None:
+            embeddings = self._weight_counts(tfidf, global_counts[:, self._cluster_columns[cluster]])
+        else:
+            embeddings = tfidf.transform(s.to_original_text() for s in sentences)
         if self.transformer_for_embedding:
-            self.transformer_for_embedding.model.eval()
-            for chunk in chunks(sentences):
-                self.transformer_for_embedding.embed(chunk)
-                for sentence in chunk:
-                    sentence.embedding.to("cpu")
-            transformer_embeddings = np.array([sentence.embedding.to("cpu").numpy() for sentence in sentences])
-            embeddings = np.hstack((embeddings.toarray(), transformer_embeddings))
+            missing = [s for s in sentences if id(s) not in self._embedding_cache]
+            computed = self._embed_with_transformer(missing)
+            transformer_embeddings = np.stack(
+                [self._embedding_cache[id(s)] if id(s) in self._embedding_cache else computed[id(s)] for s in sentences]
+            )
+            embeddings = sparse.hstack(
+                [embeddings.astype(np.float32), sparse.csr_matrix(transformer_embeddings.astype(np.float32))],
+                format="csr",
+            )
         return embeddings
 
+    def _predict_proba(self, cluster: str, embeddings):
+        """
+        Same output as predict_proba of the cluster OneVsRestClassifier but builds the DMatrix once and calls the
+        XGBoost boosters directly instead of going through the sklearn wrapper for every class.
+        """
+        classifier: OneVsRestClassifier = self.cluster_classifier[cluster]
+        dmatrix = DMatrix(embeddings)
+        predictions = []
+        for estimator in classifier.estimators_:
+            if isinstance(estimator, XGBClassifier):
+                predictions.append(estimator.get_booster().predict(dmatrix))
+            else:
+                predictions.append(estimator.predict_proba(embeddings)[:, 1])
+        return np.column_stack(predictions)
+
     def train(
         self,
         upload_to_gcp: bool = False,
@@ -171,6 +289,7 @@ class Ranker:
         train_until_cluster: int = None,
         n_jobs_ova: Union[float, int] = 1,
         n_jobs_xgb: Union[float, int] = -1,
+        n_jobs_clusters: Union[float, int] = 1,
         scale_pos_weight: str = "max",
         tree_method: str = "auto",
         booster: str = "dart",  # gbtree gblinear
@@ -188,7 +307,9 @@ class Ranker:
         :param train_starting_from_cluster: From which cluster index to start. Useful for pausing and resuming training.
         :param train_until_cluster: With which cluster index to end. Useful for pausing and resuming training.
         :param n_jobs_ova: How many hard forks to create for one vs rest. Usefull for paralellizing the training.
-        :param n_jobs_xgb: How many threads to use in XGBoost train. Default all.
+        :param n_jobs_xgb: How many threads to use in XGBoost train. Default all, or the CPUs divided by n_jobs_clusters.
+        :param n_jobs_clusters: How many clusters to train at the same time in separate processes. Can't be used with
+            transformer_for_embedding, as every process would load its own copy of the transformer.
         :param scale_pos_weight: Wether to use the max or the mean of the cluster as scale_pos_weight
         :param tree_method: Tree method for XGBoost
         :param booster: Booster for XGBoost
@@ -206,30 +327,65 @@ class Ranker:
             n_jobs_ova = max(1, int(multiprocessing.cpu_count() * n_jobs_ova))
         elif n_jobs_ova < 0:
             n_jobs_ova = max(1, multiprocessing.cpu_count() + n_jobs_ova)
+        if 0 < n_jobs_clusters < 1:
+            n_jobs_clusters = max(1, int(multiprocessing.cpu_count() * n_jobs_clusters))
+        elif n_jobs_clusters < 0:
+            n_jobs_clusters = max(1, multiprocessing.cpu_count() + n_jobs_clusters)
+        if n_jobs_clusters > 1 and transformer_for_embedding:
+            raise ValueError("n_jobs_clusters > 1 can't be used together with transformer_for_embedding")
         if 0 < n_jobs_xgb < 1:
             n_jobs_xgb = max(1, int(multiprocessing.cpu_count() * n_jobs_xgb))
-        for i, cluster in enumerate(clusters_to_train):
-            logger.info(f"Training for cluster {cluster} - {i}/{len_clusters}")
-            self.train_cluster(
-                cluster,
-                upload_to_gcp=upload_to_gcp,
-                split_types_train=split_types_train,
-                augmentation=augmentation,
-                use_incorrect_matcher_predictions=use_incorrect_matcher_predictions,
-                subset=subset,
-                transformer_for_embedding=transformer_for_embedding,
-                log_statistics_while_train=log_statistics_while_train,
-                n_jobs_ova=n_jobs_ova,
-                n_jobs_xgb=n_jobs_xgb,
-                scale_pos_weight=scale_pos_weight,
-                tree_method=tree_method,
-                booster=booster,
-                subsample=subsample,
-                colsample_bytree=colsample_bytree,
+        elif n_jobs_xgb < 0 and n_jobs_clusters > 1:
+            n_jobs_xgb = max(1, multiprocessing.cpu_count() // n_jobs_clusters)
+        train_cluster_args = dict(
+            upload_to_gcp=upload_to_gcp,
+            split_types_train=split_types_train,
+            augmentation=augmentation,
+            use_incorrect_matcher_predictions=use_incorrect_matcher_predictions,
+            subset=subset,
+            transformer_for_embedding=transformer_for_embedding,
+            log_statistics_while_train=log_statistics_while_train,
+            n_jobs_ova=n_jobs_ova,
+            n_jobs_xgb=n_jobs_xgb,
+            scale_pos_weight=scale_pos_weight,
+            tree_method=tree_method,
+            booster=booster,
+            subsample=subsample,
+            colsample_bytree=colsample_bytree,
+        )
+        if n_jobs_clusters == 1:
+            for i, cluster in enumerate(clusters_to_train):
+                logger.info(f"Training for cluster {cluster} - {i}/{len_clusters}")
+                self.train_cluster(cluster, **train_cluster_args)
+        else:
+            logger.info(f"Training {n_jobs_clusters} clusters in parallel")
+            trained_clusters = Parallel(n_jobs=n_jobs_clusters, backend="loky")(
+                delayed(_train_cluster)(self._cluster_training_copy(cluster), cluster, train_cluster_args)
+                for cluster in clusters_to_train
             )
+            for cluster, (label_binarizer, tfidf, classifier) in zip(clusters_to_train, trained_clusters):
+                self.cluster_label_binarizer[cluster] = label_binarizer
+                self.cluster_tfidf[cluster] = tfidf
+                self.cluster_classifier[cluster] = classifier
+                self._class_to_column.pop(cluster, None)
+            self._global_vectorizer = None
 
         logger.info("Training Complete")
 
+    def _cluster_training_copy(self, cluster: str):
+        """
+        Shallow copy holding only what train_cluster needs for one cluster, so it is cheap to send to a worker process.
+        """
+        ranker = copy.copy(self)
+        ranker.corpus = None
+        ranker.mappings = None
+        ranker._cluster_labels = {cluster: self._cluster_labels[cluster]}
+        ranker.cluster_classifier, ranker.cluster_label_binarizer, ranker.cluster_tfidf = {}, {}, {}
+        ranker._class_to_column, ranker._cluster_columns, ranker._embedding_cache = {}, {}, {}
+        ranker._global_vectorizer = None
+        ranker.transformer_for_embedding = None
+        return ranker
+
     def train_cluster(
         self,
         cluster: str,
@@ -262,10 +418,12 @@ class Ranker:
             logger.info("Cluster has no sentences")
             self.cluster_tfidf[cluster] = None
             self.cluster_classifier[cluster] = None
-            return
+            return self.cluster_label_binarizer[cluster], None, None
 
-        self._set_tfidf(cluster, sentences)
-        embeddings = self._get_embeddings(cluster, sentences, transformer_for_embedding)
+        tfidf_embeddings = self._set_tfidf(cluster, sentences)
+        embeddings = self._get_embeddings(
+            cluster, sentences, transformer_for_embedding, tfidf_embeddings=tfidf_embeddings
+        )
         labels = self._get_labels_matrix(cluster, sentences)
 
         del sentences
@@ -303,32 +461,33 @@ class Ranker:
         self.save_cluster(cluster)
         if upload_to_gcp:
             self.upload_cluster_to_gcp(cluster)
+        return self.cluster_label_binarizer[cluster], self.cluster_tfidf[cluster], clf
 
     def predict(self, sentences: List[Sentence], return_probabilities=True, filenames: List[str] = []):
         logger.info("Predicting ranker")
         label_name = "ranker_proba" if return_probabilities else "ranker"
+        self._precompute_transformer_embeddings(sentences)
+        global_counts = self._get_global_counts(sentences)
         for cluster in self.clusters:
             logger.info(cluster)
-            classes = self.cluster_label_binarizer[cluster].classes_
             classifier = self.cluster_classifier.get(cluster)
+            # Labels with probability 0 are not added, consumers treat a missing ranker_proba label as 0
             if not classifier:
-                for sentence in sentences:
-                    for label in classes:
-                        sentence.add_label("ranker_proba", label, 0.0)
-            elif return_probabilities:
-                embeddings = self._get_embeddings(cluster, sentences)
-                predictions = classifier.predict_proba(embeddings)
+                continue
+            classes = self.cluster_label_binarizer[cluster].classes_
+            embeddings = self._get_embeddings(cluster, sentences, global_counts=global_counts)
+            if return_probabilities:
+                predictions = self._predict_proba(cluster, embeddings)
                 for sentence, prediction in zip(sentences, predictions):
-                    for i, label in enumerate(classes):
-                        sentence.add_label("ranker_proba", label, prediction[i])
+                    for i in np.flatnonzero(prediction):
+                        sentence.add_label("ranker_proba", classes[i], prediction[i])
             else:
-                embeddings = self._get_embeddings(cluster, sentences)
-                predictions = self.cluster_classifier[cluster].predict(embeddings)
-                classes = self.cluster_label_binarizer[cluster].classes_
+                predictions = classifier.predict(embeddings)
                 for sentence, prediction in zip(sentences, predictions):
                     for i, pred in enumerate(prediction):
                         if pred:
                             sentence.add_label("ranker", classes[i], 1.0)
+        self._embedding_cache = {}
 
         if not filenames:
             filenames = self.corpus.filenames["test"]
@@ -342,6 +501,31 @@ class Ranker:
             filenames,
         )
 
+    def predictions_from_probabilities(
+        self, sentences: List[Sentence], filenames: List[str] = [], threshold: float = 0.5
+    ):
+        """
+        Adds the labels predict would add with return_probabilities=False using the ranker_proba labels of a
+        previous predict, without running the classifiers again.
+        """
+        for sentence in sentences:
+            sentence.remove_labels("ranker")
+            for label in sentence.get_labels("ranker_proba"):
+                if label.score > threshold:
+                    sentence.add_label("ranker", label.value, 1.0)
+
+        if not filenames:
+            filenames = self.corpus.filenames["test"]
+
+        save_predictions_to_file(
+            self.models_path / self.indexer / "predictions_ranker",
+            f"{self.dir_name}.json",
+            sentences,
+            "ranker",
+            False,
+            filenames,
+        )
+
     def eval_weighted(
         self, eval_weighted_metrics: List[Metrics] = [Metrics.map, Metrics.summary], first_n_digits: int = 0
     ):
@@ -390,11 +574,8 @@ class Ranker:
                 logger.info(predictions.shape)
             else:
                 embeddings = self._get_embeddings(cluster, sentences)
-                predictions = classifier.predict_proba(embeddings)
-            aps = []
-            for y_true, y_scores in zip(labels_matrix, predictions):
-                aps.append(average_precision_score(y_true, y_scores))
-            return statistics.mean(aps), len(sentences)
+                predictions = self._predict_proba(cluster, embeddings)
+            return calculate_mean_average_precision_matrix(labels_matrix, predictions), len(sentences)
         elif metric == Metrics.summary:
             if not classifier:
                 predictions = np.zeros_like(labels_matrix)
@@ -450,3 +631,7 @@ class Ranker:
         upload_blob_file(
             base_path / f"tfidf_{cluster}.pickle", f"{self.indexer}/{self.dir_name}/tfidf_{cluster}.pickle"
         )
+
+
+def _train_cluster(ranker: Ranker, cluster: str, train_cluster_args: dict):
+    return ranker.train_cluster(cluster, **train_cluster_args)
@@ -18,6 +18,14 @@ def label_in_cluster(cluster: str, label: str, mappings: dict, multi_cluster: bo
         return cluster == mappings[label]
 
 
+def labels_per_cluster(mappings: dict, multi_cluster: bool):
+    cluster_labels = defaultdict(set)
+    for label, clusters in mappings.items():
+        for cluster in clusters if multi_cluster else [clusters]:
+            cluster_labels[cluster].add(label)
+    return cluster_labels
+
+
 def create_latex_table_with_component_analysis(component_analysis_filepath: Path):
     with open(component_analysis_filepath) as f:
         component_analysis = json.load(f)